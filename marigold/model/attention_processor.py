@@ -0,0 +1,69 @@
+import torch
+import torch.nn.functional as F
+
+
+class ConstantContextAttnProcessor:
+    """
+    Cross-attention processor for a constant context, Marigold always conditions on the empty text embed.
+        The key and value projections of the context are computed once by `set_context` and broadcast
+        over the batch, instead of being recomputed for every sample at every timestep.
+        The passed encoder_hidden_states are ignored while a context is set.
+    """
+
+    def __init__(self):
+        self.key = None  # [1, heads, L, head_dim]
+        self.value = None
+
+    @torch.no_grad()
+    def set_context(self, attn, context):
+        """
+        Precompute the projections of context [1, L, D] with the weights of attn, in their dtype and device.
+        """
+        if attn.norm_cross:
+            context = attn.norm_encoder_hidden_states(context)
+        self.key = self._split_heads(attn, attn.to_k(context))
+        self.value = self._split_heads(attn, attn.to_v(context))
+
+    def clear_context(self):
+        self.key = None
+        self.value = None
+
+    @staticmethod
+    def _split_heads(attn, x):
+        batch_size, length, inner_dim = x.shape
+        return x.view(batch_size, length, attn.heads, inner_dim // attn.heads).transpose(1, 2)
+
+    def __call__(self, attn, hidden_states, encoder_hidden_states=None, attention_mask=None, temb=None, *args, **kwargs):
+        if self.key is None:
+            raise RuntimeError("ConstantContextAttnProcessor used before set_context")
+        residual = hidden_states
+
+        input_ndim = hidden_states.ndim
+        if input_ndim == 4:
+            batch_size, channel, height, width = hidden_states.shape
+            hidden_states = hidden_states.view(batch_size, channel, height * width).transpose(1, 2)
+        batch_size = hidden_states.shape[0]
+
+        if attn.group_norm is not None:
+            hidden_states = attn.group_norm(hidden_states.transpose(1, 2)).transpose(1, 2)
+
+        query = self._split_heads(attn, attn.to_q(hidden_states))
+        key = self.key.expand(batch_size, -1, -1, -1)
+        value = self.value.expand(batch_size, -1, -1, -1)
+
+        hidden_states = F.scaled_dot_product_attention(query, key, value, dropout_p=0.0, is_causal=False)
+        hidden_states = hidden_states.transpose(1, 2).flatten(2).to(query.dtype)
+
+        # linear proj
+        hidden_states = attn.to_out[0](hidden_states)
+        # dropout
+        hidden_states = attn.to_out[1](hidden_states)
+
+        if input_ndim == 4:
+            hidden_states = hidden_states.transpose(-1, -2).reshape(batch_size, channel, height, width)
+
+        if attn.residual_connection:
+            hidden_states = hidden_states + residual
+
+        hidden_states = hidden_states / attn.rescale_output_factor
+        return hidden_states
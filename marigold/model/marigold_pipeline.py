@@ -4,12 +4,11 @@
 import logging
 from typing import Dict
 
+import diffusers
 import numpy as np
 import torch
 from diffusers import (
-    DDIMScheduler,
-    DDPMScheduler,
-    PNDMScheduler,
+    AutoencoderKL,
     SchedulerMixin,
     UNet2DConditionModel,
 )
@@ -19,10 +18,32 @@ from torch.nn.parameter import Parameter
 from tqdm.auto import tqdm
 from transformers import CLIPTextModel, CLIPTokenizer
 
+from .attention_processor import ConstantContextAttnProcessor
 from .rgb_encoder import RGBEncoder
 from .stacked_depth_AE import StackedDepthAE
 
 
+# Schedulers whose step() keeps no state between steps, their timesteps are only set when they change
+STATELESS_NOISE_SCHEDULERS = {"DDIMScheduler", "DDPMScheduler"}
+
+# Selectable noise schedulers. The few-step multistep solvers need newer diffusers versions,
+# those not available in the installed version are left out.
+NOISE_SCHEDULERS: Dict[str, type] = {
+    name: getattr(diffusers, name)
+    for name in [
+        "DDIMScheduler",
+        "DDPMScheduler",
+        "PNDMScheduler",
+        "DPMSolverMultistepScheduler",  # DPM-Solver++
+        "UniPCMultistepScheduler",
+        "EulerDiscreteScheduler",
+        "HeunDiscreteScheduler",
+        "LCMScheduler",
+    ]
+    if hasattr(diffusers, name)
+}
+
+
 class MarigoldPipeline(nn.Module):
     """
     Marigold monocular depth estimator.
@@ -43,9 +64,16 @@ class MarigoldPipeline(nn.Module):
         noise_scheduler_type="DDIMScheduler",
         enable_gradient_checkpointing=False,
         enable_xformers=True,
+        torch_dtype=None,
+        cache_text_kv=True,
     ) -> None:
         super().__init__()
 
+        # Weights are loaded directly in torch_dtype (if given), without an fp32 copy in memory
+        load_kwargs = {"low_cpu_mem_usage": True}
+        if torch_dtype is not None:
+            load_kwargs["torch_dtype"] = torch_dtype
+
         self.rgb_latent_scale_factor = rgb_latent_scale_factor
         self.depth_latent_scale_factor = depth_latent_scale_factor
         self.device = "cpu"
@@ -57,7 +85,7 @@ class MarigoldPipeline(nn.Module):
 
         # Denoising UNet
         self.unet: UNet2DConditionModel = UNet2DConditionModel.from_pretrained(
-            unet_pretrained_path["path"], subfolder=unet_pretrained_path["subfolder"]
+            unet_pretrained_path["path"], subfolder=unet_pretrained_path["subfolder"], **load_kwargs
         )
         logging.info(f"pretrained UNet loaded from: {unet_pretrained_path}")
         if 8 != self.unet.config["in_channels"]:
@@ -67,11 +95,28 @@ class MarigoldPipeline(nn.Module):
             self.unet.enable_xformers_memory_efficient_attention()
         else:
             self.unet.disable_xformers_memory_efficient_attention()
+        # The cross-attention context is always the empty text embed, precompute its keys/values
+        self._context_processors: Dict[str, ConstantContextAttnProcessor] = {}
+        self._context_kv_key = None
+        if cache_text_kv:
+            self._set_constant_context_processors()
+
+        # Load the VAE only once if the image encoder and depth autoencoder share it
+        shared_vae = None
+        if rgb_encoder_pretrained_path == depht_ae_pretrained_path:
+            shared_vae = AutoencoderKL.from_pretrained(
+                rgb_encoder_pretrained_path["path"],
+                subfolder=rgb_encoder_pretrained_path["subfolder"],
+                **load_kwargs,
+            )
+            logging.info(f"pretrained AutoencoderKL loaded from: {rgb_encoder_pretrained_path}")
 
         # Image encoder
         self.rgb_encoder = RGBEncoder(
             pretrained_path=rgb_encoder_pretrained_path["path"],
             subfolder=rgb_encoder_pretrained_path["subfolder"],
+            vae=shared_vae,
+            **load_kwargs,
         )
         logging.info(
             f"pretrained RGBEncoder loaded from: {rgb_encoder_pretrained_path}"
@@ -82,6 +127,8 @@ class MarigoldPipeline(nn.Module):
         self.depth_ae = StackedDepthAE(
             pretrained_path=depht_ae_pretrained_path["path"],
             subfolder=depht_ae_pretrained_path["subfolder"],
+            vae=shared_vae,
+            **load_kwargs,
         )
         logging.info(
             f"pretrained Depth Autoencoder loaded from: {rgb_encoder_pretrained_path}"
@@ -103,23 +150,23 @@ class MarigoldPipeline(nn.Module):
             self.depth_ae.vae.enable_gradient_checkpointing()
 
         # Noise scheduler
-        if "DDPMScheduler" == noise_scheduler_type:
-            self.noise_scheduler: SchedulerMixin = DDPMScheduler.from_pretrained(
-                noise_scheduler_pretrained_path["path"],
-                subfolder=noise_scheduler_pretrained_path["subfolder"],
-            )
-        elif "DDIMScheduler" == noise_scheduler_type:
-            self.noise_scheduler: SchedulerMixin = DDIMScheduler.from_pretrained(
-                noise_scheduler_pretrained_path["path"],
-                subfolder=noise_scheduler_pretrained_path["subfolder"],
-            )
-        elif "PNDMScheduler" == noise_scheduler_type:
-            self.noise_scheduler: SchedulerMixin = PNDMScheduler.from_pretrained(
-                noise_scheduler_pretrained_path["path"],
-                subfolder=noise_scheduler_pretrained_path["subfolder"],
-            )
-        else:
+        if noise_scheduler_type not in NOISE_SCHEDULERS:
             raise NotImplementedError
+        self.noise_scheduler: SchedulerMixin = NOISE_SCHEDULERS[noise_scheduler_type].from_pretrained(
+            noise_scheduler_pretrained_path["path"],
+            subfolder=noise_scheduler_pretrained_path["subfolder"],
+        )
+        self.noise_scheduler_type = noise_scheduler_type
+        # Other schedulers are built from the checkpoint's scheduler config
+        self._noise_scheduler_config = self.noise_scheduler.config
+
+        # torch.compile'd UNet/VAE callables, see enable_compile. A plain dict, so they aren't registered as submodules
+        self._compiled = {}
+
+        # Per-call state reused across calls, see forward
+        self._timesteps_key = None
+        self._text_embed_cache = {}
+        self._unet_input_buffer = None
 
         # Text embed for empty prompt (always in CPU)
         if empty_text_embed is None:
@@ -158,6 +205,68 @@ class MarigoldPipeline(nn.Module):
             **kwargs,
         )
 
+    def set_noise_scheduler(self, noise_scheduler_type):
+        """
+        Switch to another scheduler of NOISE_SCHEDULERS, configured from the checkpoint's scheduler config.
+        """
+        if noise_scheduler_type == self.noise_scheduler_type:
+            return
+        if noise_scheduler_type not in NOISE_SCHEDULERS:
+            raise NotImplementedError
+        self.noise_scheduler = NOISE_SCHEDULERS[noise_scheduler_type].from_config(self._noise_scheduler_config)
+        self.noise_scheduler_type = noise_scheduler_type
+        self._timesteps_key = None
+        logging.info(f"Noise scheduler set to {noise_scheduler_type}")
+
+    @property
+    def compiled(self):
+        return len(self._compiled) > 0
+
+    def enable_compile(self, mode=None):
+        """
+        Run the UNet, RGB encoder and depth decoder through torch.compile (inductor, also on CPU).
+            Graphs are specialized per input shape, callers should keep the batch shapes to a
+            few buckets (e.g. by padding ragged batches). The compiled callables stay with the
+            pipeline, and inductor's FX graph cache keeps compiled artifacts across processes.
+        """
+        if self.compiled:
+            return
+        import torch._dynamo
+        try:
+            import torch._inductor.config
+            torch._inductor.config.fx_graph_cache = True
+        except (ImportError, AttributeError):  # older torch
+            pass
+        torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 64)
+        self._compiled = {
+            "unet": torch.compile(self.unet, mode=mode, dynamic=False),
+            "rgb_encoder": torch.compile(self.rgb_encoder, mode=mode, dynamic=False),
+            "depth_decoder": torch.compile(self.depth_ae.decode, mode=mode, dynamic=False),
+        }
+        logging.info("torch.compile enabled for UNet and VAE")
+
+    def disable_compile(self):
+        self._compiled = {}
+
+    def _set_constant_context_processors(self):
+        processors = {}
+        for name, processor in self.unet.attn_processors.items():
+            if name.endswith("attn2.processor"):  # cross-attention
+                processor = ConstantContextAttnProcessor()
+                self._context_processors[name[: -len(".processor")]] = processor
+            processors[name] = processor
+        self.unet.set_attn_processor(processors)
+
+    def _prepare_context_kv(self, device, dtype):
+        # (Re)compute the cross-attention keys/values of the empty text embed when device or dtype change
+        key = (str(device), dtype)
+        if self._context_kv_key == key:
+            return
+        context = self.empty_text_embed.to(device=device, dtype=dtype)  # [1, 2, 1024]
+        for module_name, processor in self._context_processors.items():
+            processor.set_context(self.unet.get_submodule(module_name), context)
+        self._context_kv_key = key
+
     def _replace_unet_conv_in(self):
         # Replace the first layer to accept 8 in_channels. Only applied when loading pretrained SD U-Net
         _weight = self.unet.conv_in.weight.clone()  # [320, 4, 3, 3]
@@ -178,14 +287,40 @@ class MarigoldPipeline(nn.Module):
         self.unet.config["in_channels"] = 8
         return
 
-    def to(self, device):
-        self.rgb_encoder.to(device)
-        self.depth_ae.to(device)
-        self.unet.to(device)
-        self.empty_text_embed = self.empty_text_embed.to(device)
-        self.device = device
+    def to(self, device=None, dtype=None):
+        # Converts the loaded weights in place, e.g. when only the precision changes.
+        # Only the given arguments are passed on, diffusers warns about dtype=None on plain device moves
+        to_kwargs = {k: v for k, v in (("device", device), ("dtype", dtype)) if v is not None}
+        self.rgb_encoder.to(**to_kwargs)
+        self.depth_ae.to(**to_kwargs)
+        self.unet.to(**to_kwargs)
+        if device is not None:
+            self.empty_text_embed = self.empty_text_embed.to(device)
+            self.device = device
+        self._text_embed_cache = {}
+        self._unet_input_buffer = None
+        self._context_kv_key = None
+        for processor in self._context_processors.values():
+            processor.clear_context()
         return self
 
+    def _batch_empty_text_embed(self, batch_size, device, dtype):
+        # Expanded view of the empty text embed for a batch, cached per (batch size, device, dtype)
+        key = (batch_size, str(device), dtype)
+        if key not in self._text_embed_cache:
+            self._text_embed_cache[key] = self.empty_text_embed.to(device=device, dtype=dtype).expand(
+                (batch_size, -1, -1)
+            )  # [B, 2, 1024]
+        return self._text_embed_cache[key]
+
+    def _get_unet_input_buffer(self, shape, device, dtype):
+        # UNet input [B, 8, h, w] reused across calls, the RGB half is written once per call
+        buffer = self._unet_input_buffer
+        if buffer is None or buffer.shape != shape or buffer.device != device or buffer.dtype != dtype:
+            buffer = torch.empty(shape, device=device, dtype=dtype)
+            self._unet_input_buffer = buffer
+        return buffer
+
     def forward(
         self,
         rgb_in,
@@ -194,15 +329,29 @@ class MarigoldPipeline(nn.Module):
         show_pbar=False,
         init_depth_latent=None,
         return_depth_latent=False,
+        rgb_latent=None,
+        denoising_strength=1.0,
     ):
-        device = rgb_in.device
-        precision = self.unet.dtype    
-        # Set timesteps
-        self.noise_scheduler.set_timesteps(num_inference_steps, device=device)
-        timesteps = self.noise_scheduler.timesteps  # [T]
-
+        """
+        Run the denoising loop.
+            rgb_latent: precomputed (scaled) RGB latent [B, 4, h, w], as returned by
+                `encode_rgb`. When given, `rgb_in` is ignored and may be None, so an image
+                can be encoded once and fanned out (e.g. with `expand`) over an ensemble.
+            init_depth_latent: warm start from this depth latent (e.g. the one returned for the
+                previous video frame with `return_depth_latent`), re-noised to `denoising_strength`
+                (0-1, the fraction of the schedule to run), only the remaining timesteps are run.
+        """
         # Encode image
-        rgb_latent = self.encode_rgb(rgb_in)
+        if rgb_latent is None:
+            rgb_latent = self.encode_rgb(rgb_in)
+        device = rgb_latent.device
+        precision = self.unet.dtype
+        # Set timesteps, only when they change for schedulers without per-run state
+        timesteps_key = (num_inference_steps, str(device))
+        if self.noise_scheduler_type not in STATELESS_NOISE_SCHEDULERS or timesteps_key != self._timesteps_key:
+            self.noise_scheduler.set_timesteps(num_inference_steps, device=device)
+            self._timesteps_key = timesteps_key
+        timesteps = self.noise_scheduler.timesteps  # [T]
 
         # Initial depth map (noise)
         if init_depth_latent is not None:
@@ -210,15 +359,28 @@ class MarigoldPipeline(nn.Module):
             assert (
                 init_depth_latent.shape == rgb_latent.shape
             ), "initial depth latent should be the size of [B, 4, H/8, W/8]"
-            depth_latent = init_depth_latent
-            depth_latent = torch.randn(rgb_latent.shape, device=device, dtype=precision)
+            # Skip the start of the schedule and noise the initial latent to the first remaining timestep
+            n_steps = min(num_inference_steps, max(1, round(num_inference_steps * denoising_strength)))
+            t_start = (num_inference_steps - n_steps) * self.noise_scheduler.order
+            timesteps = timesteps[t_start:]
+            if hasattr(self.noise_scheduler, "set_begin_index"):
+                self.noise_scheduler.set_begin_index(t_start)
+            noise = torch.randn(rgb_latent.shape, device=device, dtype=precision)
+            depth_latent = self.noise_scheduler.add_noise(init_depth_latent, noise, timesteps[:1])
         else:
             depth_latent = torch.randn(rgb_latent.shape, device=device)  # [B, 4, h, w]
+            # sigma-based schedulers (Euler, Heun) start from scaled noise
+            depth_latent = depth_latent * self.noise_scheduler.init_noise_sigma
 
         # Expand text embeding for batch
-        batch_empty_text_embed = self.empty_text_embed.repeat(
-            (rgb_latent.shape[0], 1, 1)
-        ).to(device=device, dtype=precision)  # [B, 2, 1024]
+        batch_empty_text_embed = self._batch_empty_text_embed(rgb_latent.shape[0], device, precision)
+        self._prepare_context_kv(device, precision)
+
+        # UNet input, the RGB latent goes first (this order is important) and only the depth half changes per step
+        b, c, h, w = rgb_latent.shape
+        unet_input = self._get_unet_input_buffer((b, 2 * c, h, w), device, precision)
+        unet_input[:, :c].copy_(rgb_latent)
+        unet_input_depth = unet_input[:, c:]
 
         # Export intermediate denoising steps
         if num_output_inter_results > 0:
@@ -235,7 +397,7 @@ class MarigoldPipeline(nn.Module):
                 .astype(int)
                 - 1
             )
-            steps_to_output = timesteps[_idx]
+            steps_to_output = set(int(k) % len(timesteps) for k in _idx)  # step indices
 
         # Denoising loop
         if show_pbar:
@@ -243,22 +405,20 @@ class MarigoldPipeline(nn.Module):
         else:
             iterable = enumerate(timesteps)
         for i, t in iterable:
-            unet_input = torch.cat(
-                [rgb_latent, depth_latent], dim=1
-            )  # this order is important
-            unet_input = unet_input.to(dtype=precision)
+            unet_input_depth.copy_(self.noise_scheduler.scale_model_input(depth_latent, t))
             # predict the noise residual
-            noise_pred = self.unet(
+            noise_pred = self._compiled.get("unet", self.unet)(
                 unet_input, t, encoder_hidden_states=batch_empty_text_embed
             ).sample  # [B, 4, h, w]
 
             # compute the previous noisy sample x_t -> x_t-1
             depth_latent = self.noise_scheduler.step(
                 noise_pred, t, depth_latent
-            ).prev_sample.to(dtype=precision)
-            
+            ).prev_sample
+            if depth_latent.dtype != precision:
+                depth_latent = depth_latent.to(dtype=precision)
 
-            if num_output_inter_results > 0 and t in steps_to_output:
+            if num_output_inter_results > 0 and i in steps_to_output:
                 depth_latent_ls.append(depth_latent.detach().clone())
                 #depth_latent_ls = depth_latent_ls.to(dtype=precision)
                 inter_steps.append(t - 1)
@@ -279,7 +439,7 @@ class MarigoldPipeline(nn.Module):
                 return depth
 
     def encode_rgb(self, rgb_in):
-        rgb_latent = self.rgb_encoder(rgb_in)  # [B, 4, h, w]
+        rgb_latent = self._compiled.get("rgb_encoder", self.rgb_encoder)(rgb_in)  # [B, 4, h, w]
         rgb_latent = rgb_latent * self.rgb_latent_scale_factor
         return rgb_latent 
 
@@ -291,7 +451,7 @@ class MarigoldPipeline(nn.Module):
     def decode_depth(self, depth_latent):
         #depth_latent = depth_latent.to(dtype=torch.float16)
         depth_latent = depth_latent / self.depth_latent_scale_factor
-        depth = self.depth_ae.decode(depth_latent)  # [B, 1, H, W]
+        depth = self._compiled.get("depth_decoder", self.depth_ae.decode)(depth_latent)  # [B, 1, H, W]
         return depth 
 
     @staticmethod
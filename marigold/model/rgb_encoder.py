@@ -12,11 +12,13 @@ class RGBEncoder(nn.Module):
     The encoder of pretrained Stable Diffusion VAE
     """
     
-    def __init__(self, pretrained_path, subfolder=None) -> None:
+    def __init__(self, pretrained_path=None, subfolder=None, vae=None, **kwargs) -> None:
         super().__init__()
         
-        vae: AutoencoderKL = AutoencoderKL.from_pretrained(pretrained_path, subfolder=subfolder)
-        logging.info(f"pretrained AutoencoderKL loaded from: {pretrained_path}")
+        # An already loaded VAE can be passed in to share its weights with the depth decoder
+        if vae is None:
+            vae: AutoencoderKL = AutoencoderKL.from_pretrained(pretrained_path, subfolder=subfolder, **kwargs)
+            logging.info(f"pretrained AutoencoderKL loaded from: {pretrained_path}")
         
         self.rgb_encoder = nn.Sequential(
             vae.encoder,
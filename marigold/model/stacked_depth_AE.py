@@ -14,11 +14,14 @@ class StackedDepthAE(nn.Module):
         Decode: The average of 3 chennels are taken as output.
     """
 
-    def __init__(self, pretrained_path, subfolder=None) -> None:
+    def __init__(self, pretrained_path=None, subfolder=None, vae=None, **kwargs) -> None:
         super().__init__()
 
-        self.vae: AutoencoderKL = AutoencoderKL.from_pretrained(pretrained_path, subfolder=subfolder)
-        logging.info(f"pretrained AutoencoderKL loaded from: {pretrained_path}")
+        # An already loaded VAE can be passed in to share its weights with the RGB encoder
+        if vae is None:
+            vae = AutoencoderKL.from_pretrained(pretrained_path, subfolder=subfolder, **kwargs)
+            logging.info(f"pretrained AutoencoderKL loaded from: {pretrained_path}")
+        self.vae: AutoencoderKL = vae
 
     def forward(self, depth_in):
         depth_latent = self.encode(depth_in)
@@ -1,8 +1,10 @@
 # Author: Bingxin Ke
 # Last modified: 2023-12-11
 
-import torch
 import math
+import os
+
+import torch
 
 
 # Search table for suggested max. inference batch size
@@ -24,15 +26,83 @@ bs_search_table = [
 
 
 
-def find_batch_size(n_repeat, input_res):
-    total_vram = torch.cuda.mem_get_info()[1] / 1024.0**3
+# Peak inference memory per sample in elements per input pixel, derived from the table above
+# (fp32, e.g. (23 GB - model) / 7 samples at 768x768), used for the RAM-based estimate on CPU
+sample_elements_per_pixel = 1200
+# Share of the available RAM the batch may use, the rest is left to the OS and other processes
+ram_usage_fraction = 0.75
+
+
+def _available_memory_gb(device=None):
+    """
+    Memory available to this process in GB.
+        On CUDA devices free VRAM plus what torch's caching allocator already reserved (including the
+        loaded model, which the tested batch sizes account for), comparable to the total VRAM the search
+        table is keyed by. Available RAM otherwise, the loaded model is already accounted for.
+    """
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    device = torch.device(device)
+    if "cuda" == device.type:
+        return (torch.cuda.mem_get_info(device)[0] + torch.cuda.memory_reserved(device)) / 1024.0**3
+    try:
+        import psutil
+        return psutil.virtual_memory().available / 1024.0**3
+    except ImportError:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE") / 1024.0**3
+
+
+def _limit_batch_size(bs, n_repeat):
+    # Don't exceed n_repeat, and split it into even batches rather than a full and a small one
+    if bs > n_repeat:
+        bs = n_repeat
+    elif bs > math.ceil(n_repeat / 2) and bs < n_repeat:
+        bs = math.ceil(n_repeat / 2)
+    return bs
+
+
+def find_batch_size(n_repeat, input_res, device=None, dtype=torch.float32):
+    """
+    Suggested inference batch size for n_repeat samples at input_res (max. edge of the working resolution).
+        On CUDA devices from the search table and the VRAM, on CPU from a per-sample memory estimate
+        at input_res and dtype and the available RAM.
+    """
+    if device is None:
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if "cuda" != torch.device(device).type:
+        sample_gb = input_res**2 * sample_elements_per_pixel * torch.finfo(dtype).bits / 8 / 1024.0**3
+        bs = int(_available_memory_gb(device) * ram_usage_fraction / sample_gb)
+        return _limit_batch_size(max(1, bs), n_repeat)
+
+    total_vram = _available_memory_gb(device)
     
     for settings in sorted(bs_search_table, key=lambda k: (k['res'], -k['total_vram'])):
         if input_res <= settings['res'] and total_vram >= settings['total_vram']:
-            bs = settings['bs']
-            if bs > n_repeat:
-                bs = n_repeat
-            elif bs > math.ceil(n_repeat / 2) and bs < n_repeat:
-                bs = math.ceil(n_repeat / 2)
-            return bs
-    return 1
\ No newline at end of file
+            return _limit_batch_size(settings['bs'], n_repeat)
+    return 1
+
+
+def is_oom_error(e):
+    """
+    Whether e was raised because the device (or host) ran out of memory.
+    """
+    if isinstance(e, torch.cuda.OutOfMemoryError):
+        return True
+    message = str(e)
+    return isinstance(e, RuntimeError) and (
+        "out of memory" in message
+        or "can't allocate memory" in message
+        or "not enough memory" in message
+    )
+
+
+def pack_ensemble_jobs(n_images, n_repeat):
+    """
+    The (image, ensemble member) pairs of several images, as the image index of every member.
+        Consecutive slices of this list are processed as batches, so batches are filled
+        across images and images are completed in order.
+        n_repeat: ensemble size, for all images or a list with one per image
+    """
+    if isinstance(n_repeat, int):
+        n_repeat = [n_repeat] * n_images
+    return [i for i in range(n_images) for _ in range(n_repeat[i])]
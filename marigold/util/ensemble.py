@@ -20,21 +20,70 @@ def inter_distances(tensors):
     return dist
 
 
-def ensemble_depths(input_images, regularizer_strength=0.02, max_iter=2, tol=1e-3, reduction='median', max_res=None, disp=False, device='cuda'):
-    """ 
-    To ensemble multiple affine-invariant depth images (up to scale and shift),
-        by aligning estimating the scale and shift
+def mean_sq_inter_distance(tensors):
+    """
+    Mean of the squared distances between each two depth maps, same as
+        torch.mean(inter_distances(tensors)**2) in O(N) instead of O(N^2) memory.
+        Per pixel, sum_{i<j} (a_i - a_j)^2 = N * sum_i (a_i - mean)^2, so the mean over
+        the N(N-1)/2 pairs is twice the unbiased variance across the depth maps.
+    """
+    return 2 * torch.mean(torch.var(tensors, dim=0))
+
+
+def _reduce(transformed_arrays, reduction):
+    if 'mean' == reduction:
+        return torch.mean(transformed_arrays, dim=0)
+    elif 'median' == reduction:
+        return torch.median(transformed_arrays, dim=0).values
+    else:
+        raise ValueError
+
+
+def align_depths_lstsq(input_images, reduction='median', max_iter=2, tol=1e-3):
+    """
+    Estimate per-image scale and shift with batched closed-form least squares, on-device.
+        Every iteration fits all members at once to the current reduced ensemble
+        (argmin_{s_i, t_i} ||s_i * d_i + t_i - ref||^2), then rescales the joint
+        prediction to [0, 1], which is the fixed point of the near/far regularizer.
+    Returns s, t as tensors of shape [N].
+    """
+    n_img = input_images.shape[0]
+    depths = input_images.reshape((n_img, -1)).to(torch.float32)
+
+    # init guess, same as the BFGS engine
+    _min = torch.min(depths, dim=1).values
+    _max = torch.max(depths, dim=1).values
+    s = 1.0 / (_max - _min)
+    t = -1 * s * _min
+
+    d_mean = torch.mean(depths, dim=1)
+    d_centered = depths - d_mean.view(-1, 1)
+    d_var = torch.mean(d_centered**2, dim=1).clamp_min(1e-12)
+    for _ in range(max_iter):
+        ref = _reduce(depths * s.view(-1, 1) + t.view(-1, 1), reduction)
+        ref_mean = torch.mean(ref)
+        s_new = torch.mean(d_centered * (ref - ref_mean), dim=1) / d_var
+        t_new = ref_mean - s_new * d_mean
+
+        # near/far: the joint prediction should span [0, 1]
+        pred = _reduce(depths * s_new.view(-1, 1) + t_new.view(-1, 1), reduction)
+        pred_min = torch.min(pred)
+        pred_range = (torch.max(pred) - pred_min).clamp_min(1e-12)
+        s_new = s_new / pred_range
+        t_new = (t_new - pred_min) / pred_range
+
+        converged = torch.max(torch.abs(torch.cat([s_new - s, t_new - t]))) < tol
+        s, t = s_new, t_new
+        if converged:
+            break
+    return s, t
+
+
+def _align_depths_bfgs(input_images, regularizer_strength, max_iter, tol, reduction, disp, device):
+    """
+    Estimate per-image scale and shift by minimizing the pairwise-distance objective with BFGS.
     """
-    device = input_images.device
-    original_input = input_images.clone()
     n_img = input_images.shape[0]
-    ori_shape = input_images.shape
-            
-    if max_res is not None:
-        scale_factor = torch.min(max_res / torch.tensor(ori_shape[-2:]))
-        if scale_factor < 1:
-            downscaler = torch.nn.Upsample(scale_factor=scale_factor, mode='nearest')
-            input_images = downscaler(torch.from_numpy(input_images)).numpy()
 
     # init guess
     _min = np.min(input_images.reshape((n_img, -1)).cpu().numpy(), axis=1)
@@ -55,15 +104,9 @@ def ensemble_depths(input_images, regularizer_strength=0.02, max_iter=2, tol=1e-
         t = torch.from_numpy(t).to(device)
         
         transformed_arrays = input_images * s.view((-1, 1, 1)) + t.view((-1, 1, 1))
-        dists = inter_distances(transformed_arrays)
-        sqrt_dist = torch.sqrt(torch.mean(dists**2))
+        sqrt_dist = torch.sqrt(mean_sq_inter_distance(transformed_arrays))
         
-        if 'mean' == reduction:
-            pred = torch.mean(transformed_arrays, dim=0)
-        elif 'median' == reduction:
-            pred = torch.median(transformed_arrays, dim=0).values
-        else:
-            raise ValueError
+        pred = _reduce(transformed_arrays, reduction)
         
         near_err = torch.sqrt((0 - torch.min(pred))**2)
         far_err = torch.sqrt((1 - torch.max(pred))**2)
@@ -77,10 +120,43 @@ def ensemble_depths(input_images, regularizer_strength=0.02, max_iter=2, tol=1e-
     l = len(x)
     s = x[:int(l/2)]
     t = x[int(l/2):]
-    
-    # Prediction
     s = torch.from_numpy(s).to(device)
     t = torch.from_numpy(t).to(device)
+    return s, t
+
+
+def ensemble_depths(input_images, regularizer_strength=0.02, max_iter=2, tol=1e-3, reduction='median', max_res=None, disp=False, device='cuda', method='bfgs', normalize=True):
+    """ 
+    To ensemble multiple affine-invariant depth images (up to scale and shift),
+        by aligning estimating the scale and shift
+        method: 'bfgs' minimizes the pairwise-distance objective with scipy,
+                'lstsq' uses the batched closed-form alignment of `align_depths_lstsq`, which always
+                rescales exactly to [0, 1] and so ignores regularizer_strength
+        max_res: if set, scale and shift are fitted on a copy downsampled to this max. edge
+        normalize: scale and shift the result to [0, 1], otherwise it's left as aligned,
+                e.g. to normalize a video with a common range across frames
+    """
+    device = input_images.device
+    original_input = input_images.clone()
+    ori_shape = input_images.shape
+            
+    # Fit scale and shift on an area-downsampled proxy, they are applied to the full resolution input below
+    if max_res is not None:
+        scale_factor = max_res / max(ori_shape[-2:])
+        if scale_factor < 1:
+            proxy_size = [max(1, round(d * scale_factor)) for d in ori_shape[-2:]]
+            input_images = torch.nn.functional.interpolate(
+                input_images.unsqueeze(1).to(torch.float32), size=proxy_size, mode='area'
+            ).squeeze(1)
+
+    if 'lstsq' == method:
+        s, t = align_depths_lstsq(input_images, reduction=reduction, max_iter=max_iter, tol=tol)
+    elif 'bfgs' == method:
+        s, t = _align_depths_bfgs(input_images, regularizer_strength, max_iter, tol, reduction, disp, device)
+    else:
+        raise ValueError(f"Unknown ensemble method: {method}")
+    
+    # Prediction
     transformed_arrays = original_input * s.view(-1, 1, 1) + t.view(-1, 1, 1)
     if 'mean' == reduction:
         aligned_images = torch.mean(transformed_arrays, dim=0)
@@ -95,6 +171,9 @@ def ensemble_depths(input_images, regularizer_strength=0.02, max_iter=2, tol=1e-
     else:
         raise ValueError
     
+    if not normalize:
+        return aligned_images, uncertainty
+
     # Scale and shift to [0, 1]
     _min = torch.min(aligned_images)
     _max = torch.max(aligned_images)
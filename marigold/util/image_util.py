@@ -43,6 +43,72 @@ def colorize_depth_maps(depth_map, min_depth, max_depth, cmap='Spectral', valid_
     return img_colored
 
 
+_colormap_luts = {}
+
+
+def get_colormap_lut(cmap='Spectral', device='cpu'):
+    """
+    Colormap as a lookup table tensor [N, 3] (N is the colormap's own resolution, 256 for most),
+        quantized to 8 bit like the uint8 output of colorize_depth_maps. Cached per cmap and device.
+    """
+    key = (cmap, str(device))
+    if key not in _colormap_luts:
+        cm = matplotlib.colormaps[cmap]
+        lut = cm(np.arange(cm.N), bytes=True)[:, 0:3]  # integer input indexes the table directly
+        _colormap_luts[key] = (torch.from_numpy(lut).float() / 255).to(device)
+    return _colormap_luts[key]
+
+
+def colorize_depth_maps_lut(depth_map, min_depth, max_depth, cmap='Spectral'):
+    """
+    Colorize a batch of depth maps [B, H, W] with a single gather on the device they live on.
+        min_depth, max_depth: scalars or tensors [B]
+    Returns [B, H, W, 3], value in (0, 1).
+    """
+    lut = get_colormap_lut(cmap, depth_map.device)
+    n = lut.shape[0]
+    if isinstance(min_depth, torch.Tensor):
+        min_depth = min_depth.view(-1, 1, 1)
+    if isinstance(max_depth, torch.Tensor):
+        max_depth = max_depth.view(-1, 1, 1)
+    depth = ((depth_map.float() - min_depth) / (max_depth - min_depth)).clip(0, 1)
+    # same binning as matplotlib colormaps
+    idx = (depth * n).long().clamp(max=n - 1)
+    return lut[idx]
+
+
+PERCENTILE_CHUNK_NUMEL = 1 << 24
+
+
+def depth_percentile_bounds(depth_map, percentile=0.03, max_samples=None, shared=False):
+    """
+    Lower and upper percentile of a batch of depth maps [B, H, W], both from a single np.percentile pass
+        per map, over chunks of maps so memory stays bounded for long sequences.
+        max_samples: if set, use an evenly strided subsample of at most this many pixels per map
+        shared: compute the bounds over the whole batch, for stable colors across a sequence,
+            from a subsample of at most PERCENTILE_CHUNK_NUMEL pixels in total
+    Returns min, max tensors [B].
+    """
+    n_img = depth_map.shape[0]
+    depths = depth_map.reshape((n_img, -1))
+    if shared:
+        max_samples = min(max_samples or depths.shape[1], max(1, PERCENTILE_CHUNK_NUMEL // n_img))
+    if max_samples is not None and depths.shape[1] > max_samples:
+        stride = -(-depths.shape[1] // max_samples)  # ceil
+        depths = depths[:, ::stride]
+    if shared:
+        depths = depths.reshape((1, -1))
+
+    chunk = max(1, PERCENTILE_CHUNK_NUMEL // depths.shape[1])
+    bounds = np.concatenate([
+        np.percentile(depths[i:i + chunk].float().cpu().numpy(), [percentile, 100 - percentile], axis=1).T
+        for i in range(0, depths.shape[0], chunk)
+    ], axis=0)  # [B, 2]
+    bounds = torch.from_numpy(bounds).to(device=depth_map.device, dtype=torch.float32)
+    bounds = bounds.expand(n_img, 2)
+    return bounds[:, 0], bounds[:, 1]
+
+
 def chw2hwc(chw):
     assert 3 == len(chw.shape)
     if isinstance(chw, torch.Tensor):
@@ -61,6 +127,34 @@ def resize_max_res(img: Image.Image, max_edge_resolution):
     
     resized_img = img.resize((new_width, new_height))
     return resized_img
-    
-    
-    
\ No newline at end of file
+
+
+def bucket_size(height, width, max_edge_resolution=0, multiple=64):
+    """
+    Working resolution (height, width) for an image: scaled down to max_edge_resolution (0 keeps
+        the resolution) and snapped to multiples of multiple, so inputs fall into a few bucket shapes.
+    """
+    scale = 1.0
+    if max_edge_resolution > 0:
+        scale = min(1.0, max_edge_resolution / max(height, width))
+    return (
+        max(multiple, round(height * scale / multiple) * multiple),
+        max(multiple, round(width * scale / multiple) * multiple),
+    )
+
+
+def resize_tensor(images, size):
+    """
+    Batched, torch-native resize of images [B, C, H, W] or depth maps [B, H, W] to size (h, w):
+        area averaging when downscaling, bilinear when upscaling.
+    """
+    squeeze = images.dim() == 3
+    if squeeze:
+        images = images.unsqueeze(1)
+    if tuple(images.shape[-2:]) != tuple(size):
+        dtype = images.dtype
+        mode = 'area' if size[0] <= images.shape[-2] and size[1] <= images.shape[-1] else 'bilinear'
+        kwargs = {} if mode == 'area' else {"align_corners": False}
+        images = torch.nn.functional.interpolate(images.float(), size=size, mode=mode, **kwargs).to(dtype)
+    return images.squeeze(1) if squeeze else images
+
@@ -0,0 +1,154 @@
+import logging
+import os
+import threading
+import weakref
+from collections import OrderedDict
+
+
+def model_size_gb(model):
+    """
+    Memory held by the parameters and buffers of model in GB.
+    """
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors) / 1024.0**3
+
+
+class _CacheEntry:
+    def __init__(self, model, device):
+        self.model = model
+        self.device = device
+        self.offloaded = False
+        self.owners = weakref.WeakSet()
+        self.finalizers = weakref.WeakKeyDictionary()  # owner: weakref.finalize, called when it's collected
+        self.size_gb = model_size_gb(model)
+
+
+class ModelCache:
+    """
+    Process-wide registry of loaded models, shared by all node instances.
+        Entries are keyed by (checkpoint path, dtype, device) and reference counted by their owners
+        (node instances, held weakly so recreated nodes don't pin models forever).
+        Models without owners are kept in LRU order and evicted once the cache grows over max_memory_gb,
+        released models can be offloaded to CPU instead of being discarded. Models whose owners were all
+        garbage collected without releasing them are offloaded to CPU, so they don't stay on the device.
+    """
+
+    def __init__(self, max_memory_gb=8.0):
+        self.max_memory_gb = max_memory_gb
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._orphaned = []  # weak refs to entries that lost an owner to garbage collection
+
+    def get(self, key, loader, owner, convert=None):
+        """
+        The model for key, loaded with loader() on a miss. key[-1] is the device it's placed on.
+            convert: on a miss, an entry of the same checkpoint (key[0]) and device that is not used by
+                another owner is converted in place with convert(model) instead of loading from disk,
+                e.g. when only the dtype (key[1]) changes. convert returns None if the model can't be
+                converted (e.g. upcasting would keep the rounded weights), then it's loaded from disk,
+                after moving the declined entries to CPU so both aren't held on the device at once.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None and convert is not None:
+                convertible = [
+                    other_key for other_key, other in self._entries.items()
+                    if other_key[0] == key[0] and other_key[-1] == key[-1]
+                    and all(o is owner for o in other.owners)
+                ]
+                for other_key in reversed(convertible):
+                    converted = convert(self._entries[other_key].model)
+                    if converted is None:
+                        continue
+                    entry = self._entries.pop(other_key)
+                    entry.model = converted
+                    entry.size_gb = model_size_gb(entry.model)
+                    self._entries[key] = entry
+                    logging.info(f"Model cache: converted {other_key} to {key}")
+                    break
+                if entry is None:
+                    for other_key in convertible:
+                        self._offload(other_key, self._entries[other_key])
+            if entry is None:
+                device = key[-1]
+                entry = _CacheEntry(loader(), device)
+                self._entries[key] = entry
+                logging.info(f"Model cache: loaded {key}")
+            if entry.offloaded:
+                entry.model.to(entry.device)
+                entry.offloaded = False
+                logging.info(f"Model cache: restored {key} from CPU")
+            self._entries.move_to_end(key)
+            if owner not in entry.owners:
+                entry.owners.add(owner)
+                entry.finalizers[owner] = weakref.finalize(owner, self._owner_collected, weakref.ref(entry))
+            self._offload_orphaned()
+            return entry.model
+
+    def release(self, key, owner, offload=False):
+        """
+        Drop owner's reference to key. Unreferenced models are discarded, or moved to CPU if offload.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            entry.owners.discard(owner)
+            finalizer = entry.finalizers.pop(owner, None)
+            if finalizer is not None:
+                finalizer.detach()
+            if len(entry.owners) > 0:
+                self._offload_orphaned()
+                return
+            if offload:
+                self._offload(key, entry)
+            else:
+                del self._entries[key]
+                logging.info(f"Model cache: discarded {key}")
+            self._offload_orphaned()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def _owner_collected(self, entry_ref):
+        # Runs from garbage collection, possibly in a thread that holds the lock already,
+        # then the entry is handled at the end of that thread's get/release instead
+        self._orphaned.append(entry_ref)
+        if self._lock.acquire(blocking=False):
+            try:
+                self._offload_orphaned()
+            finally:
+                self._lock.release()
+
+    def _offload_orphaned(self):
+        while len(self._orphaned) > 0:
+            entry = self._orphaned.pop()()
+            # iterating a WeakSet only yields the owners that are still alive
+            if entry is None or any(True for _ in entry.owners):
+                continue
+            key = next((k for k, e in self._entries.items() if e is entry), None)
+            if key is not None:
+                self._offload(key, entry)
+        self._evict()
+
+    def _offload(self, key, entry):
+        if not entry.offloaded:
+            entry.model.to("cpu")
+            entry.offloaded = True
+            logging.info(f"Model cache: offloaded {key} to CPU")
+
+    def _evict(self):
+        total_gb = sum(entry.size_gb for entry in self._entries.values())
+        for key in list(self._entries.keys()):
+            if total_gb <= self.max_memory_gb:
+                break
+            entry = self._entries[key]
+            if len(entry.owners) > 0:
+                continue
+            del self._entries[key]
+            total_gb -= entry.size_gb
+            logging.info(f"Model cache: evicted {key}")
+
+
+model_cache = ModelCache(max_memory_gb=float(os.environ.get("MARIGOLD_MODEL_CACHE_GB", 8.0)))
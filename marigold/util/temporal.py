@@ -0,0 +1,73 @@
+import torch
+import torch.nn.functional as F
+
+from .tiling import align_to_guide
+
+
+def _proxy(images, max_res):
+    """
+    Area-downsampled copy of images [B, C, H, W] or [B, H, W] with max. edge max_res.
+    """
+    squeeze = images.dim() == 3
+    if squeeze:
+        images = images.unsqueeze(1)
+    scale_factor = max_res / max(images.shape[-2:])
+    images = images.to(torch.float32)
+    if scale_factor < 1:
+        size = [max(1, round(d * scale_factor)) for d in images.shape[-2:]]
+        images = F.interpolate(images, size=size, mode='area')
+    return images.squeeze(1) if squeeze else images
+
+
+def frame_differences(images, max_res=64):
+    """
+    Mean absolute difference of every frame of images [B, C, H, W] to the previous one,
+        on a low resolution proxy. The first frame has no predecessor and gets inf.
+    """
+    proxy = _proxy(images, max_res)
+    diffs = torch.mean(torch.abs(proxy[1:] - proxy[:-1]), dim=(1, 2, 3))
+    return torch.cat([torch.full((1,), float('inf'), device=diffs.device), diffs])
+
+
+def temporal_normalize(depths, uncertainties, continues, window=5, max_res=256):
+    """
+    Normalize ensembled but not yet normalized depth maps of a video to [0, 1] without flicker.
+        depths, uncertainties: [B, H, W], from ensemble_depths(..., normalize=False)
+        continues: bool [B], whether a frame continues the shot of the previous frame
+        Within a shot, every frame's scale and shift is carried forward by aligning it to the previous
+        (already aligned) frame, then the depth range used for normalization is averaged over a
+        sliding window of frames instead of taken per frame.
+    Returns the normalized depths and uncertainties [B, H, W].
+    """
+    depths = depths.to(torch.float32)
+    uncertainties = uncertainties.to(torch.float32)
+    n_frames = depths.shape[0]
+
+    # Carry scale and shift forward through the shot
+    proxy = _proxy(depths, max_res)
+    s = torch.ones(n_frames, device=depths.device)
+    t = torch.zeros(n_frames, device=depths.device)
+    for i in range(1, n_frames):
+        if continues[i]:
+            s_i, t_i = align_to_guide(proxy[i:i + 1], proxy[i - 1:i] * s[i - 1] + t[i - 1])
+            s[i], t[i] = s_i[0], t_i[0]
+    depths = depths * s.view(-1, 1, 1) + t.view(-1, 1, 1)
+    uncertainties = uncertainties * torch.abs(s).view(-1, 1, 1)
+
+    # Depth range averaged over a sliding window, not crossing shot boundaries
+    _min = torch.amin(depths, dim=(1, 2))
+    _max = torch.amax(depths, dim=(1, 2))
+    shot = torch.cumsum(~torch.as_tensor(continues, device=depths.device), dim=0)
+    half = window // 2
+    smooth_min = torch.empty_like(_min)
+    smooth_max = torch.empty_like(_max)
+    for i in range(n_frames):
+        lo, hi = max(0, i - half), min(n_frames, i + half + 1)
+        same_shot = shot[lo:hi] == shot[i]
+        smooth_min[i] = _min[lo:hi][same_shot].mean()
+        smooth_max[i] = _max[lo:hi][same_shot].mean()
+
+    _range = (smooth_max - smooth_min).view(-1, 1, 1)
+    depths = ((depths - smooth_min.view(-1, 1, 1)) / _range).clip(0, 1)
+    uncertainties = uncertainties / _range
+    return depths, uncertainties
@@ -0,0 +1,106 @@
+import torch
+import torch.nn.functional as F
+
+
+def tile_starts(length, tile, overlap):
+    """
+    Start offsets of tiles of size tile covering length, overlapping by at least overlap.
+    """
+    if length <= tile:
+        return [0]
+    stride = max(1, tile - overlap)
+    n_tiles = -(-(length - tile) // stride) + 1  # ceil
+    # spread the tiles evenly, the last one ends at the border
+    return [round(i * (length - tile) / (n_tiles - 1)) for i in range(n_tiles)]
+
+
+def split_tiles(images, tile_size, overlap):
+    """
+    Split images [B, C, H, W] into overlapping tiles.
+    Returns the tiles [B * T, C, th, tw] (image major) and the T boxes (top, left, th, tw).
+    """
+    H, W = images.shape[-2:]
+    th, tw = min(tile_size, H), min(tile_size, W)
+    boxes = [
+        (top, left, th, tw)
+        for top in tile_starts(H, th, overlap)
+        for left in tile_starts(W, tw, overlap)
+    ]
+    tiles = torch.stack([images[:, :, top:top + h, left:left + w] for top, left, h, w in boxes], dim=1)
+    return tiles.flatten(0, 1), boxes
+
+
+def feather_weights(h, w, overlap, device=None):
+    """
+    Blending weights of a tile [h, w], ramping up linearly over overlap pixels from each edge.
+    """
+    ramp = max(1, overlap)
+
+    def _ramp(n):
+        x = torch.arange(n, device=device, dtype=torch.float32)
+        return torch.minimum(x + 1, n - x).div(ramp).clamp(max=1.0)
+
+    return _ramp(h).view(-1, 1) * _ramp(w).view(1, -1)
+
+
+def align_to_guide(depths, guides):
+    """
+    Least squares scale and shift aligning each depth [N, h, w] to its guide [N, h, w].
+    """
+    depths = depths.flatten(1).to(torch.float32)
+    guides = guides.flatten(1).to(torch.float32)
+    d_mean = torch.mean(depths, dim=1, keepdim=True)
+    g_mean = torch.mean(guides, dim=1, keepdim=True)
+    d_centered = depths - d_mean
+    s = torch.sum(d_centered * (guides - g_mean), dim=1, keepdim=True) / torch.sum(d_centered**2, dim=1, keepdim=True).clamp_min(1e-12)
+    t = g_mean - s * d_mean
+    return s.flatten(), t.flatten()
+
+
+def merge_tiles(tile_depths, tile_uncerts, boxes, guide, overlap):
+    """
+    Merge the affine-invariant depth tiles of one image into a globally consistent depth map.
+        Every tile [T, th, tw] is aligned (scale and shift) to the matching crop of guide [H, W],
+        an upsampled low resolution pass over the whole image, then the tiles are feather blended.
+    Returns the depth and uncertainty maps [H, W], depth normalized to [0, 1].
+    """
+    guide = guide.to(torch.float32)
+    guide_crops = torch.stack([guide[top:top + h, left:left + w] for top, left, h, w in boxes])
+    s, t = align_to_guide(tile_depths, guide_crops)
+
+    th, tw = boxes[0][2:]
+    weights = feather_weights(th, tw, overlap, device=guide.device)
+    depth = torch.zeros_like(guide)
+    uncert = torch.zeros_like(guide)
+    weight_sum = torch.zeros_like(guide)
+    for i, (top, left, h, w) in enumerate(boxes):
+        depth[top:top + h, left:left + w] += weights * (tile_depths[i].to(torch.float32) * s[i] + t[i])
+        uncert[top:top + h, left:left + w] += weights * tile_uncerts[i].to(torch.float32) * torch.abs(s[i])
+        weight_sum[top:top + h, left:left + w] += weights
+    depth /= weight_sum
+    uncert /= weight_sum
+
+    # Scale and shift to [0, 1]
+    _min = torch.min(depth)
+    _max = torch.max(depth)
+    depth = (depth - _min) / (_max - _min)
+    uncert /= (_max - _min)
+    return depth, uncert
+
+
+def guide_size(H, W, max_res, multiple=8):
+    """
+    Size of the low resolution guide pass: max. edge max_res, both edges a multiple of multiple.
+    """
+    scale = min(1.0, max_res / max(H, W))
+    return (
+        max(multiple, int(H * scale) // multiple * multiple),
+        max(multiple, int(W * scale) // multiple * multiple),
+    )
+
+
+def upsample_depth(depth, size):
+    """
+    Bilinearly resize depth maps [B, h, w] to size (H, W).
+    """
+    return F.interpolate(depth.unsqueeze(1).to(torch.float32), size=size, mode='bilinear', align_corners=False).squeeze(1)
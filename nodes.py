@@ -1,29 +1,49 @@
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
 import torch
 import numpy as np
 
-from .marigold.model.marigold_pipeline import MarigoldPipeline
+from .marigold.model.marigold_pipeline import NOISE_SCHEDULERS, MarigoldPipeline
+from .marigold.util.batchsize import find_batch_size, is_oom_error, pack_ensemble_jobs
 from .marigold.util.ensemble import ensemble_depths
-from .marigold.util.image_util import chw2hwc, colorize_depth_maps, resize_max_res
+from .marigold.util.model_cache import model_cache
+from .marigold.util.temporal import frame_differences, temporal_normalize
+from .marigold.util.tiling import guide_size, merge_tiles, split_tiles, upsample_depth
+from .marigold.util.image_util import bucket_size, colorize_depth_maps_lut, depth_percentile_bounds, resize_tensor
 
 import comfy.utils
 
-def colorizedepth(depth_map, colorize_method):
-    depth_map = depth_map.cpu().numpy()
-    percentile = 0.03
-    min_depth_pct = np.percentile(depth_map, percentile)
-    max_depth_pct = np.percentile(depth_map, 100 - percentile)
-    
-    depth_colored = colorize_depth_maps(
-        depth_map, min_depth_pct, max_depth_pct, cmap=colorize_method
-    ).squeeze()  # [3, H, W], value in (0, 1)
-    depth_colored = (depth_colored * 255).astype(np.uint8)
-    depth_colored_hwc = chw2hwc(depth_colored)
-    return depth_colored_hwc
+def is_expanded_depth(image):
+    """
+    Whether image [B, H, W, C] is a single channel depth map expanded to C channels without copying.
+    """
+    return image.shape[-1] > 1 and image.stride(-1) == 0
 
 script_directory = os.path.dirname(os.path.abspath(__file__))
 empty_text_embed = torch.load(os.path.join(script_directory, "empty_text_embed.pt"), map_location="cpu")
 
+def find_checkpoint_path():
+    folders_to_check = [
+        "checkpoints/Marigold_v1_merged",
+        "checkpoints/Marigold",
+        "../../models/diffusers/Marigold_v1_merged",
+        "../../models/diffusers/Marigold",
+    ]
+    for folder in folders_to_check:
+        potential_path = os.path.join(script_directory, folder)
+        if os.path.exists(potential_path):
+            return potential_path
+
+    try:
+        from huggingface_hub import snapshot_download
+        checkpoint_path = os.path.join(script_directory, "../../models/diffusers/Marigold")
+        snapshot_download(repo_id="Bingxin/Marigold", ignore_patterns=["*.bin"], local_dir=checkpoint_path, local_dir_use_symlinks=False)
+        return checkpoint_path
+    except:
+        raise FileNotFoundError("No checkpoint directory found.")
+
 class MarigoldDepthEstimation:
     @classmethod
     def INPUT_TYPES(s):
@@ -45,109 +65,273 @@ class MarigoldDepthEstimation:
             
             "invert": ("BOOLEAN", {"default": True}),
             "keep_model_loaded": ("BOOLEAN", {"default": True}),
-            "n_repeat_batch_size": ("INT", {"default": 2, "min": 1, "max": 4096, "step": 1}),
+            "n_repeat_batch_size": ("INT", {"default": 2, "min": 0, "max": 4096, "step": 1}),
             "use_fp16": ("BOOLEAN", {"default": True}),
             },
-            
+            "optional": {
+            "ensemble_method": (
+            [   
+                'bfgs',
+                'lstsq',
+            ], {
+               "default": 'bfgs'
+            }),
+            "ensemble_max_res": ("INT", {"default": 0, "min": 0, "max": 4096, "step": 8}),
+            "offload_model": ("BOOLEAN", {"default": False}),
+            "processing_resolution": ("INT", {"default": 0, "min": 0, "max": 8192, "step": 64}),
+            "tile_size": ("INT", {"default": 0, "min": 0, "max": 4096, "step": 64}),
+            "tile_overlap": ("INT", {"default": 128, "min": 0, "max": 2048, "step": 8}),
+            "scheduler": (list(NOISE_SCHEDULERS.keys()), {"default": "DDIMScheduler"}),
+            "compile_models": ("BOOLEAN", {"default": False}),
+            "warm_start_strength": ("FLOAT", {"default": 1.0, "min": 0.05, "max": 1.0, "step": 0.05}),
+            "temporal_window": ("INT", {"default": 0, "min": 0, "max": 255, "step": 1}),
+            "similar_frame_n_repeat": ("INT", {"default": 0, "min": 0, "max": 4096, "step": 1}),
+            "similar_frame_threshold": ("FLOAT", {"default": 0.02, "min": 0.0, "max": 1.0, "step": 0.001}),
+            },
             }
     
-    RETURN_TYPES = ("IMAGE",)
-    RETURN_NAMES =("ensembled_image",)
+    RETURN_TYPES = ("IMAGE", "MASK",)
+    RETURN_NAMES =("ensembled_image", "uncertainty",)
     FUNCTION = "process"
 
     CATEGORY = "Marigold"
 
-    def process(self, image, seed, denoise_steps, n_repeat, regularizer_strength, reduction_method, max_iter, tol,invert, keep_model_loaded, n_repeat_batch_size, use_fp16):
+    def process(self, image, seed, denoise_steps, n_repeat, regularizer_strength, reduction_method, max_iter, tol,invert, keep_model_loaded, n_repeat_batch_size, use_fp16, ensemble_method='bfgs', ensemble_max_res=0, offload_model=False, processing_resolution=0, tile_size=0, tile_overlap=128, scheduler="DDIMScheduler", compile_models=False, warm_start_strength=1.0, temporal_window=0, similar_frame_n_repeat=0, similar_frame_threshold=0.02):
         batch_size = image.shape[0]
         precision = torch.float16 if use_fp16 else torch.float32
         device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         torch.manual_seed(seed)
 
         image = image.permute(0, 3, 1, 2).to(device).to(dtype=precision)
-        #load the diffusers model
-        
-        folders_to_check = [
-            "checkpoints/Marigold_v1_merged",
-            "checkpoints/Marigold",
-            "../../models/diffusers/Marigold_v1_merged",
-            "../../models/diffusers/Marigold",
-        ]
-
-        if not hasattr(self, 'marigold_pipeline') or self.marigold_pipeline is None or self.marigold_pipeline.unet.dtype != precision:
-            # Load the model only if it hasn't been loaded before
-            checkpoint_path = None
-            for folder in folders_to_check:
-                potential_path = os.path.join(script_directory, folder)
-                if os.path.exists(potential_path):
-                    checkpoint_path = potential_path
-                    break
-
-            if checkpoint_path is None:
-                try:
-                    from huggingface_hub import snapshot_download
-                    checkpoint_path = os.path.join(script_directory, "../../models/diffusers/Marigold")
-                    snapshot_download(repo_id="Bingxin/Marigold", ignore_patterns=["*.bin"], local_dir=checkpoint_path, local_dir_use_symlinks=False)
-                    
-                except:
-                    raise FileNotFoundError("No checkpoint directory found.")
-            self.marigold_pipeline = MarigoldPipeline.from_pretrained(checkpoint_path, enable_xformers=False, empty_text_embed=empty_text_embed)
-            self.marigold_pipeline = self.marigold_pipeline.to(device).half() if use_fp16 else self.marigold_pipeline.to(device)
-            self.marigold_pipeline.unet.eval()  # Set the model to evaluation mode
-        pbar = comfy.utils.ProgressBar(batch_size * n_repeat)
+        # Run at the working resolution: max. edge processing_resolution (0 keeps it), snapped to
+        # bucket shapes (multiples of 64, or of 8 at native resolution as the VAE requires)
+        input_size = tuple(image.shape[-2:])
+        working_size = bucket_size(*input_size, processing_resolution, multiple=64 if processing_resolution > 0 else 8)
+        image = resize_tensor(image, working_size)
+        #load the diffusers model, shared with the other nodes through the model cache
+        checkpoint_path = find_checkpoint_path()
+        model_key = (checkpoint_path, precision, str(device))
 
-        out = []
-        # Set the number of images to process in a batch
-        batch_process_size = n_repeat_batch_size 
+        def load_pipeline():
+            marigold_pipeline = MarigoldPipeline.from_pretrained(checkpoint_path, enable_xformers=False, empty_text_embed=empty_text_embed, torch_dtype=precision)
+            marigold_pipeline = marigold_pipeline.to(device)
+            marigold_pipeline.unet.eval()  # Set the model to evaluation mode
+            return marigold_pipeline
 
-        with torch.no_grad():
-            for i in range(batch_size):
-                # Duplicate the current image n_repeat times
-                duplicated_batch = image[i].unsqueeze(0).repeat(n_repeat, 1, 1, 1)
-                
-                # Process the duplicated batch in sub-batches
-                depth_maps = []
-                for j in range(0, n_repeat, batch_process_size):
-                    # Get the current sub-batch
-                    sub_batch = duplicated_batch[j:j + batch_process_size]
-                    
-                    # Process the sub-batch
-                    depth_maps_sub_batch = self.marigold_pipeline(sub_batch, num_inference_steps=denoise_steps, show_pbar=False)
-                    
-                    # Process each depth map in the sub-batch if necessary
-                    for depth_map in depth_maps_sub_batch:
-                        depth_map = torch.clip(depth_map, -1.0, 1.0)
-                        depth_map = (depth_map + 1.0) / 2.0
-                        depth_maps.append(depth_map)
-                        pbar.update(1)
-                
-                depth_predictions = torch.cat(depth_maps, dim=0).squeeze()
-                del duplicated_batch, depth_maps_sub_batch
-                torch.cuda.empty_cache()  # clear vram cache for ensembling
+        def convert_pipeline(pipeline):
+            # Upcasting in place would keep the rounded weights, the checkpoint is reloaded instead
+            if torch.finfo(precision).bits >= torch.finfo(pipeline.unet.dtype).bits:
+                return None
+            return pipeline.to(dtype=precision)
 
-                # Test-time ensembling
-                if n_repeat > 1:
-                    depth_map, pred_uncert = ensemble_depths(
-                        depth_predictions,
-                        regularizer_strength=regularizer_strength,
-                        max_iter=max_iter,
-                        tol=tol,
-                        reduction=reduction_method,
-                        max_res=None,
-                        device=device,
-                    )
-                
-                depth_map = depth_map.unsqueeze(2).repeat(1, 1, 3)
-                out.append(depth_map)
-                del depth_map, depth_predictions
-        if invert:
-            outstack = 1.0 - torch.stack(out, dim=0).cpu().to(torch.float32)
+        # When only the precision is lowered, the already loaded model is converted instead of reloaded
+        self.marigold_pipeline = model_cache.get(model_key, load_pipeline, owner=self, convert=convert_pipeline)
+        if getattr(self, 'model_key', None) is not None and self.model_key != model_key:
+            model_cache.release(self.model_key, self, offload=offload_model)
+        self.model_key = model_key
+        self.marigold_pipeline.set_noise_scheduler(scheduler)
+        if compile_models:
+            self.marigold_pipeline.enable_compile()
         else:
-            outstack = torch.stack(out, dim=0).cpu().to(torch.float32)
+            self.marigold_pipeline.disable_compile()
+        ensemble_kwargs = dict(
+            regularizer_strength=regularizer_strength,
+            max_iter=max_iter,
+            tol=tol,
+            reduction=reduction_method,
+            max_res=ensemble_max_res if ensemble_max_res > 0 else None,
+            device=device,
+            method=ensemble_method,
+        )
+        tiled = tile_size > 0 and max(image.shape[-2:]) > tile_size
+        # Video normalization needs the aligned depth before its per-frame normalization
+        ensemble_kwargs["normalize"] = tiled or temporal_window == 0
+        process_res = tile_size if tiled else max(image.shape[-2:])
+
+        # Set the number of images to process in a batch, the batches are filled across input images
+        # 0 is auto: picked from the available memory and the input resolution
+        self.batch_process_size = n_repeat_batch_size 
+        if self.batch_process_size == 0:
+            self.batch_process_size = find_batch_size(batch_size * n_repeat, process_res, device, precision)
+
+        with torch.no_grad():
+            if tiled:
+                out, out_uncert = self.process_tiled(image, tile_size, tile_overlap, n_repeat, denoise_steps, ensemble_kwargs)
+            else:
+                # Video: frames similar to their predecessor get a smaller ensemble
+                continues = frame_differences(image) < similar_frame_threshold
+                n_repeats = [n_repeat] * batch_size
+                if similar_frame_n_repeat > 0:
+                    n_repeats = [min(n_repeat, similar_frame_n_repeat) if c else n_repeat for c in continues.tolist()]
+                pbar = comfy.utils.ProgressBar(sum(n_repeats))
+                out, out_uncert = self.infer(image, n_repeats, denoise_steps, ensemble_kwargs, pbar, warm_start_strength, continues.tolist())
+                if temporal_window > 0:
+                    out, out_uncert = temporal_normalize(torch.stack(out), torch.stack(out_uncert), continues, window=temporal_window)
+                    out, out_uncert = out.unbind(0), out_uncert.unbind(0)
+            # Upsample back to the input size
+            depth = resize_tensor(torch.stack(out, dim=0).to(torch.float32), input_size).cpu()  # [B, H, W]
+            # per-pixel std (mean reduction) or MAD (median reduction) across the ensemble, in output depth units
+            uncertainty = resize_tensor(torch.stack(out_uncert, dim=0).to(torch.float32), input_size).cpu()
+        if invert:
+            depth = 1.0 - depth
+        # Depth is single channel, the IMAGE output is an expanded view of it instead of three copies
+        outstack = depth.unsqueeze(3).expand(-1, -1, -1, 3)
         if not keep_model_loaded:
             self.marigold_pipeline = None
+            model_cache.release(self.model_key, self, offload=offload_model)
+            self.model_key = None
             torch.cuda.empty_cache()
             torch.cuda.ipc_collect()
-        return (outstack,)
+        return (outstack, uncertainty,)
+
+    def infer(self, image, n_repeat, denoise_steps, ensemble_kwargs, pbar, warm_start_strength=1.0, continues=None):
+        """
+        Ensembled depth and uncertainty maps [H, W] of every image in image [B, 3, H, W].
+            n_repeat: ensemble size, for all images or a list with one per image
+            warm_start_strength < 1: treat the images as video frames, each ensemble member starts
+                from the depth latent of the same member of the previous frame, re-noised to this strength.
+            continues: bool per image, whether it continues the shot of the previous one, frames after a cut
+                are cold started from pure noise. By default every frame continues.
+        """
+        warm_start = warm_start_strength < 1.0
+        batch_size = image.shape[0]
+        n_repeats = n_repeat if isinstance(n_repeat, list) else [n_repeat] * batch_size
+        out = []
+        out_uncert = []
+
+        # Compiled models are specialized per batch shape, ragged batches are padded to the next power
+        # of two (capped by the batch size), so only a few shapes are compiled and little work is wasted
+        pad_batches = self.marigold_pipeline.compiled
+
+        def padded(x):
+            if not pad_batches or x is None:
+                return x
+            n = min(self.batch_process_size, 1 << (x.shape[0] - 1).bit_length())
+            if x.shape[0] >= n:
+                return x
+            return torch.cat([x, x[-1:].expand(n - x.shape[0], *x.shape[1:])], dim=0)
+
+        # Encode every image only once, the ensemble members differ only by their noise
+        rgb_latents = torch.cat([
+            self.marigold_pipeline.encode_rgb(padded(image[i:i + self.batch_process_size]))[:min(self.batch_process_size, batch_size - i)]
+            for i in range(0, batch_size, self.batch_process_size)
+        ], dim=0)
+
+        # Pack the (image, ensemble member) pairs of all images into UNet batches,
+        # images are completed in order and ensembled as soon as all their members are done
+        depth_maps = [[] for _ in range(batch_size)]
+        depth_latents = [[] for _ in range(batch_size)]
+        next_image = 0
+        jobs = pack_ensemble_jobs(batch_size, n_repeats)
+        j = 0
+        while j < len(jobs):
+            image_indices = jobs[j:j + self.batch_process_size]
+
+            init_depth_latent = None
+            if warm_start:
+                # Warm started frames depend on the previous one, so batches don't span frames
+                image_indices = [k for k in image_indices if k == image_indices[0]]
+                frame = image_indices[0]
+                if frame > 0 and (continues is None or continues[frame]):
+                    first_member = len(depth_maps[frame])
+                    # the previous frame may have a smaller ensemble, its latents are reused round-robin
+                    previous = depth_latents[frame - 1]
+                    init_depth_latent = torch.stack([previous[m % len(previous)] for m in range(first_member, first_member + len(image_indices))])
+
+            # Process the sub-batch, on OOM halve the batch size and re-run it
+            out_of_memory = False
+            try:
+                depth_maps_sub_batch = self.marigold_pipeline(
+                    None,
+                    rgb_latent=padded(rgb_latents[image_indices]),
+                    num_inference_steps=denoise_steps,
+                    show_pbar=False,
+                    init_depth_latent=padded(init_depth_latent),
+                    denoising_strength=warm_start_strength,
+                    return_depth_latent=warm_start,
+                )
+            except RuntimeError as e:
+                if not is_oom_error(e) or self.batch_process_size == 1:
+                    raise
+                out_of_memory = True
+            if out_of_memory:
+                self.batch_process_size = max(1, self.batch_process_size // 2)
+                print(f"Marigold: out of memory, retrying with batch size {self.batch_process_size}")
+                torch.cuda.empty_cache()
+                continue
+            j += len(image_indices)
+            del init_depth_latent
+            if warm_start:
+                depth_maps_sub_batch, depth_latent_sub_batch = depth_maps_sub_batch
+                depth_latents[frame].extend(depth_latent_sub_batch[:len(image_indices)].unbind(0))
+                if frame > 0 and len(depth_latents[frame]) == n_repeats[frame]:
+                    depth_latents[frame - 1] = None
+            
+            # Process each depth map in the sub-batch if necessary, padding is dropped by zip
+            for image_index, depth_map in zip(image_indices, depth_maps_sub_batch):
+                depth_map = torch.clip(depth_map, -1.0, 1.0)
+                depth_map = (depth_map + 1.0) / 2.0
+                depth_maps[image_index].append(depth_map)
+                pbar.update(1)
+            del depth_maps_sub_batch
+
+            while next_image < batch_size and len(depth_maps[next_image]) == n_repeats[next_image]:
+                depth_predictions = torch.stack(depth_maps[next_image], dim=0).squeeze(1)  # [N, H, W]
+                depth_maps[next_image] = None
+                next_image += 1
+                torch.cuda.empty_cache()  # clear vram cache for ensembling
+
+                # Test-time ensembling
+                if depth_predictions.shape[0] > 1:
+                    depth_map, pred_uncert = ensemble_depths(depth_predictions, **ensemble_kwargs)
+                else:
+                    # A single member can't be aligned or ensembled, it's only normalized
+                    depth_map = depth_predictions[0].to(torch.float32)
+                    pred_uncert = torch.zeros_like(depth_map)
+                    if ensemble_kwargs.get("normalize", True):
+                        _min = torch.min(depth_map)
+                        _max = torch.max(depth_map)
+                        depth_map = (depth_map - _min) / (_max - _min)
+                out.append(depth_map)
+                out_uncert.append(pred_uncert)
+                del depth_map, pred_uncert, depth_predictions
+        del rgb_latents
+        return out, out_uncert
+
+    def process_tiled(self, image, tile_size, tile_overlap, n_repeat, denoise_steps, ensemble_kwargs):
+        """
+        Tiled inference for images larger than tile_size: the overlapping tiles of all images are
+            denoised in shared batches, aligned to a low resolution pass over the whole image
+            and feather blended.
+        """
+        batch_size = image.shape[0]
+        H, W = image.shape[-2:]
+        tiles, boxes = split_tiles(image, tile_size, tile_overlap)
+        guide_res = guide_size(H, W, tile_size)
+        pbar = comfy.utils.ProgressBar((len(boxes) + 1) * batch_size * n_repeat)
+
+        # Global pass at the tile resolution, to make the tiles consistent
+        guide_images = torch.nn.functional.interpolate(image, size=guide_res, mode='area')
+        guides, _ = self.infer(guide_images, n_repeat, denoise_steps, ensemble_kwargs, pbar)
+        del guide_images
+        guides = upsample_depth(torch.stack(guides, dim=0), (H, W))
+
+        tile_depths, tile_uncerts = self.infer(tiles, n_repeat, denoise_steps, ensemble_kwargs, pbar)
+        del tiles
+        n_tiles = len(boxes)
+        out = []
+        out_uncert = []
+        for i in range(batch_size):
+            depth_map, pred_uncert = merge_tiles(
+                torch.stack(tile_depths[i * n_tiles:(i + 1) * n_tiles]),
+                torch.stack(tile_uncerts[i * n_tiles:(i + 1) * n_tiles]),
+                boxes,
+                guides[i],
+                tile_overlap,
+            )
+            out.append(depth_map)
+            out_uncert.append(pred_uncert)
+        return out, out_uncert
 
 class ColorizeDepthmap:
     @classmethod
@@ -180,7 +364,10 @@ class ColorizeDepthmap:
                "default": 'Spectral'
             }),
             },
-            
+            "optional": {
+            "shared_bounds": ("BOOLEAN", {"default": False}),
+            "percentile_max_samples": ("INT", {"default": 0, "min": 0, "max": 0xffffffff, "step": 1024}),
+            },
             }
     
     RETURN_TYPES = ("IMAGE",)
@@ -189,22 +376,47 @@ class ColorizeDepthmap:
 
     CATEGORY = "Marigold"
 
-    def color(self, image, colorize_method):
-        colored_images = []
-        for i in range(image.shape[0]):  # Iterate over the batch dimension
-            depth_map = image[i].squeeze().permute(2, 0, 1)
-            depth_map = depth_map[0]
-            depth_map = colorizedepth(depth_map, colorize_method)
-            depth_map = torch.from_numpy(depth_map) / 255
-            depth_map = depth_map.unsqueeze(0)
-            colored_images.append(depth_map)
-        
-        # Stack the list of tensors along a new dimension
-        colored_images = torch.cat(colored_images, dim=0)
+    def color(self, image, colorize_method, shared_bounds=False, percentile_max_samples=0):
+        depth_maps = image[:, :, :, 0]  # [B, H, W]
+        min_depth_pct, max_depth_pct = depth_percentile_bounds(
+            depth_maps,
+            percentile=0.03,
+            max_samples=percentile_max_samples if percentile_max_samples > 0 else None,
+            shared=shared_bounds,
+        )
+
+        colored_images = colorize_depth_maps_lut(depth_maps, min_depth_pct, max_depth_pct, cmap=colorize_method)
         return (colored_images,)
 
 import folder_paths
 
+# compression name: (Imath.Compression name, OpenCV flag name)
+EXR_COMPRESSIONS = {
+    "none": ("NO_COMPRESSION", "IMWRITE_EXR_COMPRESSION_NO"),
+    "RLE": ("RLE_COMPRESSION", "IMWRITE_EXR_COMPRESSION_RLE"),
+    "ZIPS": ("ZIPS_COMPRESSION", "IMWRITE_EXR_COMPRESSION_ZIPS"),
+    "ZIP": ("ZIP_COMPRESSION", "IMWRITE_EXR_COMPRESSION_ZIP"),
+    "PIZ": ("PIZ_COMPRESSION", "IMWRITE_EXR_COMPRESSION_PIZ"),
+    "PXR24": ("PXR24_COMPRESSION", "IMWRITE_EXR_COMPRESSION_PXR24"),
+    "DWAA": ("DWAA_COMPRESSION", "IMWRITE_EXR_COMPRESSION_DWAA"),
+    "DWAB": ("DWAB_COMPRESSION", "IMWRITE_EXR_COMPRESSION_DWAB"),
+}
+
+_exr_writer = None
+_exr_writer_workers = 0
+
+def get_exr_writer(num_workers):
+    """
+    Process-wide thread pool for writing EXRs, the OpenEXR/OpenCV encoders release the GIL.
+    """
+    global _exr_writer, _exr_writer_workers
+    if _exr_writer is None or _exr_writer_workers != num_workers:
+        if _exr_writer is not None:
+            _exr_writer.shutdown(wait=False)  # already queued frames are still written
+        _exr_writer = ThreadPoolExecutor(max_workers=num_workers, thread_name_prefix="exr_writer")
+        _exr_writer_workers = num_workers
+    return _exr_writer
+
 class SaveImageOpenEXR:
     def __init__(self):
         try:
@@ -232,7 +444,13 @@ class SaveImageOpenEXR:
             "images": ("IMAGE", ),
             "filename_prefix": ("STRING", {"default": "ComfyUI_EXR"})
             },
-            
+            "optional": {
+            "num_workers": ("INT", {"default": 4, "min": 1, "max": 64, "step": 1}),
+            "async_write": ("BOOLEAN", {"default": False}),
+            "channels": (["RGB", "Y", "Z"], {"default": "RGB"}),
+            "pixel_type": (["float", "half"], {"default": "float"}),
+            "compression": (list(EXR_COMPRESSIONS.keys()), {"default": "ZIP"}),
+            },
             }
     
     RETURN_TYPES = ("STRING",)
@@ -241,7 +459,7 @@ class SaveImageOpenEXR:
     OUTPUT_NODE = True
     CATEGORY = "Marigold"
 
-    def saveexr(self, images, filename_prefix):
+    def saveexr(self, images, filename_prefix, num_workers=4, async_write=False, channels="RGB", pixel_type="float", compression="ZIP"):
         import re
         filename_prefix += self.prefix_append
         full_output_folder, filename, counter, subfolder, filename_prefix = folder_paths.get_save_image_path(filename_prefix, self.output_dir, images[0].shape[1], images[0].shape[0])
@@ -251,7 +469,7 @@ class SaveImageOpenEXR:
             # Loop through the existing files
             for existing_file in os.listdir(full_output_folder):
                 # Check if the file matches the expected format
-                match = re.fullmatch(f"{filename}_(\d+)_?\.[a-zA-Z0-9]+", existing_file)
+                match = re.fullmatch(rf"{re.escape(filename)}_(\d+)_?\.[a-zA-Z0-9]+", existing_file)
                 if match:
                     # Extract the numeric portion of the filename
                     file_counter = int(match.group(1))
@@ -259,42 +477,87 @@ class SaveImageOpenEXR:
                     if file_counter > max_counter:
                         max_counter = file_counter
             return max_counter
-        
-        for image in images:
-            # Ensure the tensor is on the CPU and convert it to a numpy array
-            image_np = image.cpu().numpy()
-            image_np = image_np.astype(np.float32)
-
-            if self.use_openexr:
-                # Assuming the image is in the format of floating point 32 bit (change PIXEL_TYPE if not)
-                PIXEL_TYPE = self.Imath.PixelType(self.Imath.PixelType.FLOAT)
-                height, width, channels = image_np.shape
-
-                # Prepare the EXR header
-                header = self.OpenEXR.Header(width, height)
-                half_chan = self.Imath.Channel(PIXEL_TYPE)
-                header['channels'] = dict([(c, half_chan) for c in "RGB"])
-
-                # Split the channels for OpenEXR
-                R = image_np[:, :, 0].tostring()
-                G = image_np[:, :, 1].tostring()
-                B = image_np[:, :, 2].tostring()
-
-                # Increment the counter by 1 to get the next available value
-                counter = file_counter() + 1
-                file = f"{filename}_{counter:05}.exr"
 
-                # Write the EXR file
-                exr_file = self.OpenEXR.OutputFile(os.path.join(full_output_folder, file), header)
-                exr_file.writePixels({'R': R, 'G': G, 'B': B})
-                exr_file.close()
-            else:            
-                counter = file_counter() + 1
+        def reserve_file(counter):
+            # Create the file exclusively so concurrent queues can't pick the same name
+            while True:
                 file = f"{filename}_{counter:05}.exr"
-                exr_file = os.path.join(full_output_folder, file)
-                self.cv2.imwrite(exr_file, image_np)
+                try:
+                    os.close(os.open(os.path.join(full_output_folder, file), os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                    return file, counter
+                except FileExistsError:
+                    counter += 1
+        
+        # Frames are encoded and written concurrently, at most 2 * num_workers are queued at once
+        executor = get_exr_writer(num_workers)
+        queue_slots = threading.BoundedSemaphore(2 * num_workers)
+        futures = []
+
+        def write_done(future):
+            queue_slots.release()
+            if async_write and future.exception() is not None:
+                print(f"SaveImageOpenEXR: failed to write EXR: {future.exception()}")
 
-        return (f"/view?filename={file}&subfolder=&type=output",)
+        # Scan the folder only once, then increment the counter locally
+        counter = file_counter() + 1
+        # Contiguous planar [B, C, H, W] buffers from a single transpose and conversion of the whole batch,
+        # single channel output only takes the first channel (which is all there is for expanded depth maps)
+        n_channels = 3 if channels == "RGB" else 1
+        planar = images[:, :, :, :n_channels].permute(0, 3, 1, 2)
+        # OpenCV's EXR encoder only takes float32 data and converts it to half itself
+        planar_dtype = torch.float16 if pixel_type == "half" and self.use_openexr else torch.float32
+        planar = planar.to(dtype=planar_dtype).contiguous().cpu().numpy()
+        for image_planar in planar:
+            file, counter = reserve_file(counter)
+            counter += 1
+            exr_path = os.path.join(full_output_folder, file)
+
+            queue_slots.acquire()
+            future = executor.submit(self.write_exr, exr_path, image_planar, channels, pixel_type, compression)
+            future.add_done_callback(write_done)
+            futures.append(future)
+            results.append(f"/view?filename={file}&subfolder={subfolder}&type=output")
+
+        if not async_write:
+            for future in futures:
+                future.result()
+
+        # One url per written file, one per line
+        return ("\n".join(results),)
+
+    def write_exr(self, exr_path, image_planar, channels="RGB", pixel_type="float", compression="ZIP"):
+        # image_planar: contiguous [C, H, W] in the output pixel type (always float32 for OpenCV), C is 1 for single channel ('Y' or 'Z') output
+        if self.use_openexr:
+            PIXEL_TYPE = self.Imath.PixelType(self.Imath.PixelType.HALF if pixel_type == "half" else self.Imath.PixelType.FLOAT)
+            _, height, width = image_planar.shape
+
+            # Prepare the EXR header
+            header = self.OpenEXR.Header(width, height)
+            pixel_chan = self.Imath.Channel(PIXEL_TYPE)
+            header['channels'] = dict([(c, pixel_chan) for c in channels])
+            header['compression'] = self.Imath.Compression(getattr(self.Imath.Compression, EXR_COMPRESSIONS[compression][0]))
+
+            # The planes are contiguous already, hand them over without copying
+            pixels = dict([(c, memoryview(image_planar[i]).cast("B")) for i, c in enumerate(channels)])
+
+            # Write the EXR file
+            exr_file = self.OpenEXR.OutputFile(exr_path, header)
+            try:
+                exr_file.writePixels(pixels)
+            except TypeError:
+                # older OpenEXR bindings only accept bytes
+                exr_file.writePixels(dict([(c, plane.tobytes()) for c, plane in pixels.items()]))
+            exr_file.close()
+        else:            
+            # OpenCV names a single channel 'Y', 'Z' isn't supported
+            if image_planar.shape[0] == 1:
+                image_np = image_planar[0]
+            else:
+                image_np = np.moveaxis(image_planar, 0, -1)
+            params = [self.cv2.IMWRITE_EXR_TYPE, self.cv2.IMWRITE_EXR_TYPE_HALF if pixel_type == "half" else self.cv2.IMWRITE_EXR_TYPE_FLOAT]
+            if hasattr(self.cv2, "IMWRITE_EXR_COMPRESSION"):  # OpenCV >= 4.5.5
+                params += [self.cv2.IMWRITE_EXR_COMPRESSION, getattr(self.cv2, EXR_COMPRESSIONS[compression][1])]
+            self.cv2.imwrite(exr_path, image_np, params)
 
 class RemapDepth:
     @classmethod
@@ -315,9 +578,16 @@ class RemapDepth:
     def remap(self, image, min, max, clamp):
         if image.dtype == torch.float16:
             image = image.to(torch.float32)
+        # Remap only the first channel of expanded single channel depth maps
+        channels = image.shape[-1]
+        single_channel = is_expanded_depth(image)
+        if single_channel:
+            image = image[:, :, :, :1]
         image = min + image * (max - min)
         if clamp:
             image = torch.clamp(image, min=0.0, max=1.0)
+        if single_channel:
+            image = image.expand(-1, -1, -1, channels)
         return (image, )
 
 NODE_CLASS_MAPPINGS = {